@@ -15,9 +15,7 @@
 # | python packages:
 # |    argh, biopython, khmer, plotly
 # | others, expected inside $PATH:
-# |    bwa, bowtie2, samtools, vcftools, bcftools, bedtools, seqtk, spades, quast
-# | others, bundled inside res/ directory:
-# |    trimmomatic
+# |    bwa, bowtie2, fastp, samtools, vcftools, bcftools, bedtools, seqtk, spades, quast
 
 import os
 import io
@@ -25,16 +23,19 @@ import sys
 import argh
 import time
 import json
+import shutil
 import pandas
 import logging
+import itertools
 import requests
+import threading
 import subprocess
-import multiprocessing
 import concurrent.futures
 
 import pprint
 
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from Bio import SeqIO
 from Bio import SeqUtils
@@ -46,59 +47,89 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 def run(cmd):
-    return subprocess.run(cmd,
+    '''
+    Runs a shell command, returning the CompletedProcess with stderr merged into stdout
+    Uses bash with pipefail so a failure anywhere in a pipeline is reflected in returncode
+    '''
+    return subprocess.run('set -o pipefail; ' + cmd,
                           shell=True,
+                          executable='/bin/bash',
                           universal_newlines=True,
                           stdout=subprocess.PIPE,
                           stderr=subprocess.STDOUT)
 
 
+def background(fn, *args):
+    '''
+    Calls fn(*args) in a daemon thread, returning a Future for its result
+    Unlike executor threads, daemon threads do not delay exit if a later stage fails
+    '''
+    future = concurrent.futures.Future()
+    def target():
+        try:
+            future.set_result(fn(*args))
+        except BaseException as exception:
+            future.set_exception(exception)
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
 def name_sample(fwd_fq):
-    fwd_fq_prefix = os.path.splitext(os.path.split(fwd_fq)[1])[0]
-    return fwd_fq_prefix
+    fwd_fq_name = os.path.basename(fwd_fq)
+    for suffix in ('.fastq.gz', '.fq.gz', '.fastq', '.fq'):
+        if fwd_fq_name.endswith(suffix):
+            return fwd_fq_name[:-len(suffix)]
+    return os.path.splitext(fwd_fq_name)[0]
 
 
 def import_reads(fwd_fq, rev_fq, params):
     print('Importing reads...')
-    cmd = (
-    'cat {fwd_fq} > {out}/raw/{name}.f.fastq '
-    '&& cat {rev_fq} > {out}/raw/{name}.r.fastq '
-    '&& interleave-reads.py {out}/raw/{name}.f.fastq {out}/raw/{name}.r.fastq '
-    '> {out}/raw/{name}.fr.fastq'
-    .format(**params, fwd_fq=fwd_fq, rev_fq=rev_fq))
-    logger.info(cmd)
-    cmd_run = run(cmd)
-    logger.info(cmd_run.stdout, cmd_run.stderr)
-    print('\tDone') if cmd_run.returncode == 0 else sys.exit('ERR_IMPORT')
+    # Copy in-process rather than forking a shell for cat
+    try:
+        shutil.copyfile(fwd_fq, '{out}/raw/{name}.f.fastq'.format(**params))
+        shutil.copyfile(rev_fq, '{out}/raw/{name}.r.fastq'.format(**params))
+    except OSError as exception:
+        logger.error(exception)
+        sys.exit('ERR_IMPORT')
+    print('\tDone')
 
 
 def trim(norm_k_list, params):
     print('Trimming...')
-    # Fetch smallest norm_k for trimming with Trimmomatic min_len - Screed bug workaround
+    # Fetch smallest norm_k for trimming with fastp length_required - Screed bug workaround
     params['min_len'] = max(map(int, norm_k_list.split(',')))
+    # fastp emits interleaved pairs on stdout and orphaned mates of both reads into one file
+    # Its quality filter and polyG trimming are disabled to match Trimmomatic's adapter/length trimming
     cmd = (
-    'java -jar {pipe}/res/trimmomatic-0.33.jar PE'
-    ' {out}/raw/{name}.f.fastq'
-    ' {out}/raw/{name}.r.fastq'
-    ' {out}/trim/{name}.f_pe.fastq'
-    ' {out}/trim/{name}.f_se.fastq'
-    ' {out}/trim/{name}.r_pe.fastq'
-    ' {out}/trim/{name}.r_se.fastq'
-    ' ILLUMINACLIP:{pipe}/res/illumina_adapters.fa:2:30:10'.format(**params))
+    'fastp'
+    ' -i {out}/raw/{name}.f.fastq'
+    ' -I {out}/raw/{name}.r.fastq'
+    ' --stdout'
+    ' --unpaired1 {out}/trim/{name}.se.fastq'
+    ' --unpaired2 {out}/trim/{name}.se.fastq'
+    ' --adapter_fasta {pipe}/res/illumina_adapters.fa'
+    ' --length_required {min_len}'
+    ' --disable_quality_filtering'
+    ' --disable_trim_poly_g'
+    ' --thread {fastp_threads}'
+    ' --json {out}/trim/{name}.fastp.json'
+    ' --html {out}/trim/{name}.fastp.html'.format(**params, fastp_threads=min(params['threads'], 16)))
     if params['qual_trim']:
         print('\tQuality trimming...')
         logger.info('Quality trimming...')
-        cmd += ' SLIDINGWINDOW:4:20'.format(**params)
+        cmd += ' --cut_right --cut_right_window_size 4 --cut_right_mean_quality 20'
+    # Rename mates to name/1 and name/2 as interleave-reads.py did, so khmer -p recognises pairs
     cmd += (
-    ' MINLEN:{min_len}'
-    ' && cat {out}/trim/{name}.f_se.fastq {out}/trim/{name}.r_se.fastq'
-    ' > {out}/trim/{name}.se.fastq'
-    ' && interleave-reads.py {out}/trim/{name}.f_pe.fastq {out}/trim/{name}.r_pe.fastq'
+    ' | awk \'NR % 8 == 1 || NR % 8 == 5'
+    ' {{sub(/[ \\t].*$/, ""); sub(/\\/[12]$/, ""); $0 = $0 (NR % 8 == 1 ? "/1" : "/2")}}'
+    ' {{print}}\''
     ' > {out}/trim/{name}.fr.fastq'.format(**params))
     logger.info(cmd)
     cmd_run = run(cmd)
-    logger.info(cmd_run.stderr)
+    logger.info(cmd_run.stdout)
     print('\tDone') if cmd_run.returncode == 0 else sys.exit('ERR_TRIM')
+    with open('{out}/trim/{name}.fastp.json'.format(**params), 'r') as fastp_report:
+        logger.info(json.load(fastp_report)['filtering_result'])
 
 
 def normalise(norm_perms, params):
@@ -112,21 +143,14 @@ def normalise(norm_perms, params):
         'normalize-by-median.py -C {c} -k {k} -N 4 -x 1e8 -p'
         ' {out}/trim/{name}.fr.fastq'
         ' -o {out}/norm/{name}.norm_k{k}c{c}.fr.fastq'
-        ' && normalize-by-median.py -C {c} -k {k} -N 4 -x 1e9'
+        ' && normalize-by-median.py -C {c} -k {k} -N 4 -x 1e8'
         ' {out}/trim/{name}.se.fastq'
-        ' -o {out}/norm/{name}.norm_k{k}c{c}.se.fastq'
-        ' && split-paired-reads.py'
-        ' -1 {out}/norm/{name}.norm_k{k}c{c}.f_pe.fastq'
-        ' -2 {out}/norm/{name}.norm_k{k}c{c}.r_pe.fastq'
-        ' {out}/norm/{name}.norm_k{k}c{c}.fr.fastq'
-        ' && cat {out}/norm/{name}.norm_k{k}c{c}.fr.fastq'
-        ' {out}/norm/{name}.norm_k{k}c{c}.se.fastq >'
-        ' {out}/norm/{name}.norm_k{k}c{c}.pe_and_se.fastq'.format(**cmd_vars))
+        ' -o {out}/norm/{name}.norm_k{k}c{c}.se.fastq'.format(**cmd_vars))
         cmds.append(cmd)
         print('\tNormalising norm_c={c}, norm_k={k}'.format(**cmd_vars))
         logger.info('Normalising norm_c={c}, norm_k={k}'.format(**cmd_vars))
-    with multiprocessing.Pool(params['threads']) as pool:
-        results = pool.map(run, cmds)
+    with concurrent.futures.ThreadPoolExecutor(min(len(cmds), params['threads'])) as executor:
+        results = list(executor.map(run, cmds))
     logger.info([result.stdout + result.stdout for result in results])
     print('\tAll done') if not max([r.returncode for r in results]) else sys.exit('ERR_NORM')
     return norm_perms
@@ -143,13 +167,17 @@ def assemble(asm_perms, params):
     else:
         asm_k_fmt = 'k'
 
+    # Divide threads between concurrent SPAdes runs rather than giving each the full budget
+    n_asms = len(asm_perms) + (1 if params['no_norm'] else 0)
+    workers = max(1, min(n_asms, params['threads']))
     cmds_asm = []
     cmd_vars = dict(**params,
                     asm_k_fmt=asm_k_fmt)
+    cmd_vars['threads'] = max(1, params['threads'] // workers)
     
     if params['no_norm']:
         cmd_asm = (
-        'spades.py -m 8 -t 12'
+        'spades.py -m 8 -t {threads}'
         ' --12 {out}/trim/{name}.fr.fastq'
         ' -s {out}/trim/{name}.se.fastq'
         ' -o {out}/asm/{name}.no_norm.asm_{asm_k_fmt} --careful'.format(**cmd_vars))
@@ -161,8 +189,7 @@ def assemble(asm_perms, params):
         cmd_vars['c'] = str(asm_perm['c'])
         cmd_asm = (
         'spades.py -m 8 -t {threads}'
-        ' --pe1-1 {out}/norm/{name}.norm_k{k}c{c}.f_pe.fastq'
-        ' --pe1-2 {out}/norm/{name}.norm_k{k}c{c}.r_pe.fastq'.format(**cmd_vars))
+        ' --pe1-12 {out}/norm/{name}.norm_k{k}c{c}.fr.fastq'.format(**cmd_vars))
         if params['asm_k']:
             cmd_asm += ' -k {asm_k}'.format(**cmd_vars)
         cmd_asm += (
@@ -171,12 +198,13 @@ def assemble(asm_perms, params):
         cmds_asm.append(cmd_asm)
         print('\tAssembling norm_c={c}, norm_k={k}, asm_k={asm_k}'.format(**cmd_vars))
 
-    with multiprocessing.Pool(params['threads']) as pool:
-        results = pool.map(run, cmds_asm)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(run, cmds_asm))
     logger.info([result.stdout for result in results])
     print('\tAll done') if not max([r.returncode for r in results]) else sys.exit('ERR_ASM')
-    asms = os.listdir(params['out'] + '/asm')
-    asm_paths = [params['out'] + '/asm/' + asm + '/contigs.fasta' for asm in asms]
+    # Sorted so assembly order (and plot trace order) does not depend on the filesystem
+    asms = sorted(os.listdir(os.path.join(params['out'], 'asm')))
+    asm_paths = [os.path.join(params['out'], 'asm', asm, 'contigs.fasta') for asm in asms]
     return OrderedDict(zip(asms, asm_paths))
 
 
@@ -190,65 +218,66 @@ def prune_assemblies(asms_paths, min_len, params):
     return asms_paths_pruned 
 
 
-def gc_content(asms_paths):
-    asms_gc = {}
-    for asm, path in asms_paths.items():
-        asm_gc = []
-        for record in SeqIO.parse(path, 'fasta'):
-            asm_gc.append(SeqUtils.GC(record.seq)/100)
-        asms_gc[asm] = asm_gc
-    return asms_gc
+def map_to_assembly(asm, asm_path, params):
+    '''
+    Map original reads to a single assembly with Bowtie2
+    Alignments are streamed through the uniqueness filter into samtools sort without touching disk
+    Returns list of n_reads_mapped for each contig, or None if a command failed
+    '''
+    print('\tAligning to ' + asm)
+    cmd_vars = {**params,
+                'asm':asm,
+                'asm_path':asm_path}
+    cmds = [
+    'bowtie2-build -q {asm_path} {out}/remap/{asm}',
+    'bowtie2 -x {out}/remap/{asm} --no-unal --very-sensitive-local --threads {threads}'
+    ' -1 {out}/raw/{name}.f.fastq'
+    ' -2 {out}/raw/{name}.r.fastq'
+    ' 2> {out}/remap/{asm}.bt2.stats'
+    ' | grep -v XS:i:'
+    ' | samtools sort -@ {threads} -o {out}/remap/{asm}.uniq.bam -',
+    'samtools index {out}/remap/{asm}.uniq.bam',
+    'samtools idxstats {out}/remap/{asm}.uniq.bam'
+    ' > {out}/remap/{asm}.uniq.bam.stats']
+    cmds = [cmd.format(**cmd_vars) for cmd in cmds]
+    for cmd in cmds:
+        logger.info(cmd)
+        cmd_run = run(cmd)
+        logger.info(cmd_run.stdout)
+        cmd_prefix = cmd.split(' ')[0]
+        if cmd_run.returncode != 0:
+            logger.error('{} failed for {}'.format(cmd_prefix, asm))
+            return None
+        print('\tDone (' + cmd_prefix + ') ' + asm)
+    
+    with open('{out}/remap/{asm}.bt2.stats'.format(**cmd_vars), 'r') as bt2_stats:
+        map_prop = float(bt2_stats.read().partition('% overall')[0].split('\n')[-1].strip())/100
+    
+    # idxstats columns: contig, length, mapped, unmapped; '*' row counts unplaced reads
+    bam_stats = pandas.read_csv('{out}/remap/{asm}.uniq.bam.stats'.format(**cmd_vars),
+                                sep='\t', header=None, dtype={0: str}, keep_default_na=False)
+    return bam_stats[bam_stats[0] != '*'][2].tolist()
 
 
 def map_to_assemblies(asms_paths, params):
     '''
-    Map original reads to each assembly with Bowtie2
+    Map original reads to each assembly with Bowtie2, running assemblies concurrently
     Record mapping statistics
     Screen uniquely mapped reads and quantify reads mapped per contig
-    Returns dict of tuples containing contig_len and n_reads_mapped for each contig
+    Returns dict of lists of n_reads_mapped for each contig
     '''
     print('Aligning to assemblies... (Bowtie2)')
-    asms_coverages = {}
-    for asm, asm_path in asms_paths.items():
-        i = 0
-        print(asm, i)
-        cmd_vars = {**params,
-                    'asm':asm,
-                    'asm_path':asm_path}
-        cmds = [
-        'bowtie2-build -q {asm_path} {out}/remap/{asm}',
-        'bowtie2 -x {out}/remap/{asm} --no-unal --very-sensitive-local --threads {threads}'
-        ' -1 {out}/raw/{name}.f.fastq'
-        ' -2 {out}/raw/{name}.r.fastq'
-        ' -S {out}/remap/{asm}.sam'
-        ' 2> {out}/remap/{asm}.bt2.stats',
-        'grep -v XS:i: {out}/remap/{asm}.sam > {out}/remap/{asm}.uniq.sam',
-        'samtools view -bS {out}/remap/{asm}.uniq.sam'
-        ' | samtools sort - -o {out}/remap/{asm}.uniq.bam',
-        'samtools index {out}/remap/{asm}.uniq.bam',
-        'samtools idxstats {out}/remap/{asm}.uniq.bam'
-        ' > {out}/remap/{asm}.uniq.bam.stats',
-        'rm {out}/remap/{asm}.sam {out}/remap/{asm}.uniq.sam']
-        cmds = [cmd.format(**cmd_vars) for cmd in cmds]
-        for cmd in cmds:
-            logger.info(cmd)
-            cmd_run = run(cmd)
-            logger.info(cmd_run.stdout)
-            cmd_prefix = cmd.split(' ')[0]
-            print('\tDone (' +cmd_prefix+ ')') if cmd_run.returncode == 0 else sys.exit('ERR_REMAP')
-        
-        with open('{out}/remap/{asm}.bt2.stats'.format(**cmd_vars), 'r') as bt2_stats:
-            map_prop = float(bt2_stats.read().partition('% overall')[0].split('\n')[-1].strip())/100
-        
-        asm_coverages = []
-        with open('{out}/remap/{asm}.uniq.bam.stats'.format(**cmd_vars), 'r') as bam_stats:
-            for line in bam_stats:
-                if not line.startswith('*'):
-                    reads_mapped = int(line.strip().split('\t')[2])
-                    asm_coverages.append(int(reads_mapped))
-        
-        asms_coverages[asm] = asm_coverages
-    return asms_coverages
+    # Split the thread budget between concurrent alignments rather than oversubscribing
+    workers = max(1, min(len(asms_paths), params['threads']))
+    asm_params = dict(**params)
+    asm_params['threads'] = max(1, params['threads'] // workers)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        results = list(executor.map(map_to_assembly,
+                                    asms_paths.keys(),
+                                    asms_paths.values(),
+                                    [asm_params]*len(asms_paths)))
+    print('\tAll done') if None not in results else sys.exit('ERR_REMAP')
+    return dict(zip(asms_paths.keys(), results))
 
 
 def onecodex_lca(seq, onecodex_api_key):
@@ -264,19 +293,37 @@ def onecodex_lca(seq, onecodex_api_key):
     result['prop_hits'] = round(int(result['n_hits'])/int(result['n_lookups']), 3)
     return result
 
+lineage_lookups = {}
+lineage_lookups_lock = threading.Lock()
+
 def ebi_taxid_to_lineage(tax_id):
     '''
     Returns scientific name and lineage for a given taxid using EBI's taxonomy API
     e.g.('Retroviridae', ['Viruses', 'Retro-transcribing viruses'])
+    Lookups are shared per taxid, including those in flight on other threads, since contigs
+    across every assembly of a sample mostly share a handful of taxids. Failures are not kept
     '''
     url = 'http://www.ebi.ac.uk/ena/data/taxonomy/v1/taxon/tax-id/{}'
     if tax_id == 0 or tax_id == 1:
         return None, None
-    response = requests.get(url.format(tax_id), timeout=5)
-    result = json.loads(response.text)
-    sciname = result['scientificName']
-    taxonomy = [x for x in result['lineage'].split('; ') if x]
-    return sciname, taxonomy
+    with lineage_lookups_lock:
+        lookup = lineage_lookups.get(tax_id)
+        owner = lookup is None
+        if owner:
+            lookup = lineage_lookups[tax_id] = concurrent.futures.Future()
+    if owner:
+        try:
+            response = requests.get(url.format(tax_id), timeout=5)
+            result = json.loads(response.text)
+            sciname = result['scientificName']
+            taxonomy = [x for x in result['lineage'].split('; ') if x]
+        except Exception as exception:
+            with lineage_lookups_lock:
+                del lineage_lookups[tax_id]
+            lookup.set_exception(exception)
+        else:
+            lookup.set_result((sciname, taxonomy))
+    return lookup.result()
 
 def onecodex_lca_taxa(seqrecord, onecodex_api_key):
     '''
@@ -298,29 +345,25 @@ def fasta_onecodex_lca_taxa(fasta_path, onecodex_api_key):
     '''
     Executes onecodex_lca_taxa() in parallel for a multifasta file
     '''
-    seqrecords = SeqIO.parse(fasta_path, 'fasta')
-    taxa = {}
-    with concurrent.futures.ThreadPoolExecutor(50) as executor:
-        futures = {executor.submit(onecodex_lca_taxa, seqrecord, onecodex_api_key): seqrecord for seqrecord in seqrecords}
-        for future in concurrent.futures.as_completed(futures):
-            seqrecord = futures[future]
-            try:
-                data = future.result()
-            except Exception as exception:
-                taxa[seqrecord.id] = (None, None, None)
-                logger.info('Skipping {}'.format(seqrecord.id))
-            else:
-                taxa[seqrecord.id] = future.result()
-    return taxa
+    def lca_taxa_or_skip(seqrecord):
+        try:
+            return onecodex_lca_taxa(seqrecord, onecodex_api_key)
+        except Exception as exception:
+            logger.info('Skipping {}'.format(seqrecord.id))
+            return (None, None, None)
+
+    seqrecords = list(SeqIO.parse(fasta_path, 'fasta'))
+    with ThreadPool(50) as pool:
+        results = pool.map(lca_taxa_or_skip, seqrecords)
+    return {seqrecord.id: result for seqrecord, result in zip(seqrecords, results)}
 
 def onecodex_assemblies(asms_paths, onecodex_api_key):
     '''
     Returns OneCodex hits for a dict of assembly names and corresponding paths 
     '''
-    print('Fetching LCA taxonomic assignments... (requires network access)')
     sample_results = OrderedDict()
     for asm_name, asm_path in asms_paths.items():
-        print('\tAssembly {}'.format(asm_name))
+        logger.info('LCA assignment of assembly {}'.format(asm_name))
         sample_results[asm_name] = fasta_onecodex_lca_taxa(asm_path, onecodex_api_key)
     return sample_results
 
@@ -330,40 +373,32 @@ def seqrecords(fasta_path):
     '''
     return SeqIO.parse(fasta_path, 'fasta')
 
-def lengths(asms_paths):
+def names_lengths_gc(asms_paths):
     '''
-    Accepts path to multifasta, returns OrderedDict of sequence lengths 
+    Accepts dict of assembly names and paths, returns dicts of sequence names, lengths and GC
+    content for each assembly, tabulated in a single pass over each multifasta
     '''
-    lengths = {}
+    names, lengths, gc_contents = {}, {}, {}
     for asm_name, asm_path in asms_paths.items():
-        lengths[asm_name] = []
-        records = seqrecords(asm_path)
-        for record in records:
+        names[asm_name], lengths[asm_name], gc_contents[asm_name] = [], [], []
+        for record in seqrecords(asm_path):
+            names[asm_name].append(record.id)
             lengths[asm_name].append(len(record.seq))
-    return lengths
-
-def gc_contents(asms_paths):
-    '''
-    Accepts path to multifasta, returns OrderedDict of sequence GC content
-    '''
-    gc_contents = {}
-    for asm_name, asm_path in asms_paths.items():
-        records = seqrecords(asm_path)
-        gc_contents[asm_name] = []
-        for record in seqrecords:
-            gc_contents[record.id].append(SeqUtils.GC(record.seq)/100)
-    return gc_contents
+            gc_contents[asm_name].append(SeqUtils.GC(record.seq)/100)
+    return names, lengths, gc_contents
 
-def marker_metadata(asms_paths, lengths, gc_contents, taxa):
+def marker_metadata(asms_names, lengths, gc_contents, taxa):
     '''
     Returns summary metadata for each sequence
+    Accepts record ids per assembly in file order rather than reparsing each multifasta
     '''
     metadata = {}
-    for asm_name, asm_path in asms_paths.items():
+    for asm_name, record_ids in asms_names.items():
         metadata[asm_name] = []
-        records = seqrecords(asm_path)
-        for i, record in enumerate(records):
-            lineage = ';'.join(taxa[asm_name][record.id][1]) if taxa[asm_name][record.id][1] else ''
+        asm_taxa = taxa[asm_name]
+        for i, record_id in enumerate(record_ids):
+            sciname, taxonomy, hits = asm_taxa[record_id]
+            lineage = ';'.join(taxonomy) if taxonomy else ''
             lineage_fmt = (lineage[:40] + '..') if len(lineage) > 50 else lineage
             text = (
                 '{}<br>'
@@ -371,10 +406,10 @@ def marker_metadata(asms_paths, lengths, gc_contents, taxa):
                 'lineage: {}<br>'
                 'length: {}<br>'
                 'gc_content: {}<br>'
-                ''.format(record.id,
-                          taxa[asm_name][record.id][0],
+                ''.format(record_id,
+                          sciname,
                           0,
-                          #taxa[asm_name][record.id][2]['tax_id'],
+                          #hits['tax_id'],
                           lineage_fmt,
                           lengths[asm_name][i],
                           round(float(gc_contents[asm_name][i]), 3)))
@@ -477,10 +512,10 @@ def ebi_annotated_blast(query):
             hits_r = requests.get(results_url + call.text + '/out')
             hits = parse_hits(query['title'], hits_r.text)
             annotations_items = [hit[1] + hit[2] for hit in hits] # all there
-            annotations = list(fetch_annotation(hit[1], hit[2]) for hit in hits)
+            # Only the top hit is summarised, so skip the dbfetch round trips for the rest
+            annotations = list(fetch_annotation(hit[1], hit[2]) for hit in hits[:1])
             hits_annotations = list(zip(hits, annotations))
             # hits_annotations = list(zip(hits)) TESTING WITHOUT SEQRECORD
-            print('\t\tQuery ' + query['title'])
             logger.info(status.text + ' ' + call.text)
             # print(time.time() - start_time)
             break
@@ -496,7 +531,7 @@ def ebi_annotated_blast(query):
             break
     return (query['title'], hits_annotations)
 
-def fasta_blaster(fasta, database, max_seqs, min_len):
+def fasta_blaster(fasta, database, max_seqs, min_len, pool):
     '''
     NEEDS UPDATING FOR NESTED ORDEREDDICTS
     MIN_LEN NEEDS IMPLEMENTING
@@ -519,21 +554,21 @@ def fasta_blaster(fasta, database, max_seqs, min_len):
                 records[record.id] = record.seq
 
     queries = [build_ebi_blast_query(title, seq, database) for title, seq in records.items()]
-    with multiprocessing.Pool(30) as pool:
-        results = pool.map(ebi_annotated_blast, queries[0:max_seqs+1])
-        if len(queries) > max_seqs:
-            results += zip([q['title'] for q in queries[max_seqs+1:]], [None]*len(queries[max_seqs+1:]))
+    results = pool.map(ebi_annotated_blast, queries[0:max_seqs+1])
+    if len(queries) > max_seqs:
+        results += zip([q['title'] for q in queries[max_seqs+1:]], [None]*len(queries[max_seqs+1:]))
     return OrderedDict(results)
 
 def blast_assemblies(asms_paths, database, max_seqs, min_len):
     '''
     Returns BLAST hit information for a dict of assembly names and corresponding paths 
+    A single worker pool is shared by all assemblies
     '''
-    print('BLASTing assemblies...')
     sample_results = OrderedDict()
-    for asm_name, asm_path in asms_paths.items():
-        print('\tAssembly {}'.format(asm_name))
-        sample_results[asm_name] = fasta_blaster(asm_path, database, max_seqs, min_len)
+    with ThreadPool(30) as pool:
+        for asm_name, asm_path in asms_paths.items():
+            logger.info('BLASTing assembly {}'.format(asm_name))
+            sample_results[asm_name] = fasta_blaster(asm_path, database, max_seqs, min_len, pool)
     return sample_results
 
 def blast_superkingdoms(blast_results):
@@ -574,7 +609,7 @@ def blast_summary(blast_results, asms_covs):
 
 
 def plotly(asms_names, asms_stats, lca, blast, params):
-    cov_max = max(sum([i for i in asms_stats['covs'].values()], []))
+    cov_max = max(itertools.chain.from_iterable(asms_stats['covs'].values()))
     cov_scale_factor = round(cov_max/5000, 1) # For bubble scaling
 
     traces = []
@@ -687,8 +722,8 @@ def main(
         asm_perms = [{'k':'0', 'c':'0'}]
 
     for dir in ['raw', 'trim', 'norm', 'asm', 'asm_prune', 'remap', 'eval']:
-        if not os.path.exists(params['out'] + '/' + dir):
-            os.makedirs(params['out'] + '/' + dir)
+        if not os.path.exists(os.path.join(params['out'], dir)):
+            os.makedirs(os.path.join(params['out'], dir))
 
     import_reads(fwd_fq, rev_fq, params)
     trim(norm_k_list, params)
@@ -699,14 +734,20 @@ def main(
     asms_paths_full = assemble(asm_perms, params)
     asms_paths = prune_assemblies(asms_paths_full, min_len, params)
     
-    asms_names = {a: [r.id for r in SeqIO.parse(p, 'fasta')] for a, p in asms_paths.items()}
-    asms_lens = lengths(asms_paths)
+    asms_names, asms_lens, asms_gc = names_lengths_gc(asms_paths)
+
+    # Network-bound annotation does not depend on remapping, so overlap the two
+    if lca:
+        print('Fetching LCA taxonomic assignments in background... (requires network access)')
+        annotation = background(onecodex_assemblies, asms_paths, onecodex_api_key)
+    elif blast:
+        print('BLASTing assemblies in background...')
+        annotation = background(blast_assemblies, asms_paths, blast_db, blast_max_seqs, min_len)
     asms_covs = map_to_assemblies(asms_paths, params)
-    asms_gc = gc_content(asms_paths)
     
     if lca:
-        lca_taxa = onecodex_assemblies(asms_paths, onecodex_api_key)
-        metadata_summaries = marker_metadata(asms_paths, asms_lens, asms_gc, lca_taxa)
+        lca_taxa = annotation.result()
+        metadata_summaries = marker_metadata(asms_names, asms_lens, asms_gc, lca_taxa)
         asms_stats = dict(names=asms_names,
                           lens=asms_lens,
                           covs=asms_covs,
@@ -731,13 +772,13 @@ def main(
         # pprint.pprint(metadata_summaries)
 
     elif blast:
-        blast_results = blast_assemblies(asms_paths, blast_db, blast_max_seqs, min_len)
+        blast_results = annotation.result()
         asms_stats = dict(names=asms_names,
                           lens=asms_lens,
                           covs=asms_covs,
                           blast_summary=blast_summary(blast_results, asms_covs), 
                           blast_superkingdoms=blast_superkingdoms(blast_results),
-                          gc=gc_content(asms_paths),
+                          gc=asms_gc,
                           cpg=None)
 
     else: